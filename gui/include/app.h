@@ -4,8 +4,8 @@
 #include <QMainWindow>
 #include <QTimer>
 #include <QVector>
-#include <QMutex>
 #include <atomic>
+#include <array>
 
 class QCustomPlot;
 class QLabel;
@@ -20,7 +20,7 @@ public:
     void run();
     
     // Called from audio thread to update data
-    void updateAudioData(const double* timeData, const double* fftData, int size, double sampleRate);
+    void updateAudioData(const double* timeData, int size, const double* fftData, int fftLength, double sampleRate);
     
     // Flag to signal audio thread to stop
     std::atomic<bool> shouldStop{false};
@@ -35,16 +35,29 @@ private:
     QLabel *dominantFreqLabel;
     QLabel *closestNoteLabel;
     
-    // Thread-safe data buffers
-    QMutex dataMutex;
+    // One captured block, written by the audio thread and read by the GUI thread
+    struct AudioFrame {
+        QVector<double> amplitude;
+        QVector<double> magnitude;
+        double sampleRate{44100.0};
+    };
+    
+    // Lock-free single-producer/single-consumer ring between the audio
+    // callback and refreshPlots(). The audio thread drops frames when full.
+    static constexpr unsigned FRAME_RING_SIZE = 4;
+    std::array<AudioFrame, FRAME_RING_SIZE> frameRing;
+    std::atomic<unsigned> ringHead{0}; // Next slot written by the audio thread
+    std::atomic<unsigned> ringTail{0}; // Next slot read by the GUI thread
+    
+    // Plot buffers, only touched by the GUI thread
     QVector<double> timeBuffer;
-    QVector<double> amplitudeBuffer;
     QVector<double> freqBuffer;
     QVector<double> magnitudeBuffer;
-    bool dataReady{false};
+    QVector<int> logBandStarts; // First FFT bin of each plotted frequency band
     double currentSampleRate{44100.0};
     qint64 lastLabelUpdateTime{0};
     static constexpr qint64 LABEL_UPDATE_INTERVAL_MS = 250; // Update labels every 250ms
+    static constexpr int LOG_BAND_COUNT = 240; // Log-spaced bands drawn in the frequency plot
     
     void setupPlot(QCustomPlot *plot, const QString &xLabel, const QString &yLabel);
     void addSampleData();
@@ -10,6 +10,7 @@
 #include <QElapsedTimer>
 #include <QDateTime>
 #include <cmath>
+#include <algorithm>
 
 App::App(QWidget *parent) : QMainWindow(parent) {
     std::cout << "App initialized" << std::endl;
@@ -111,9 +112,14 @@ void App::setupPlot(QCustomPlot *plot, const QString &xLabel, const QString &yLa
     plot->xAxis->grid()->setSubGridPen(QPen(gridColor, 1, Qt::DotLine));
     plot->yAxis->grid()->setSubGridPen(QPen(gridColor, 1, Qt::DotLine));
     
-    // Add a graph
+    // Add a graph on its own buffered layer, so new data only repaints the
+    // graph instead of the whole plot
+    plot->addLayer("data", plot->layer("main"), QCustomPlot::limAbove);
+    plot->layer("data")->setMode(QCPLayer::lmBuffered);
     plot->addGraph();
+    plot->graph(0)->setLayer("data");
     plot->graph(0)->setPen(QPen(plotLineColor, 2));
+    plot->setPlottingHint(QCP::phFastPolylines);
     
     // Enable interactions
     plot->setInteractions(QCP::iRangeDrag | QCP::iRangeZoom);
@@ -146,54 +152,129 @@ void App::addSampleData() {
     frequencyDomainPlot->replot();
 }
 
-void App::updateAudioData(const double* timeData, const double* fftData, int size, double sampleRate) {
-    QMutexLocker locker(&dataMutex);
+void App::updateAudioData(const double* timeData, int size, const double* fftData, int fftLength, double sampleRate) {
+    unsigned head = ringHead.load(std::memory_order_relaxed);
+    if (head - ringTail.load(std::memory_order_acquire) == FRAME_RING_SIZE) {
+        // GUI thread is behind; drop this frame instead of blocking the audio thread
+        return;
+    }
     
-    currentSampleRate = sampleRate;
+    AudioFrame& frame = frameRing[head % FRAME_RING_SIZE];
+    int fftSize = fftLength / 2;
     
-    timeBuffer.resize(size);
-    amplitudeBuffer.resize(size);
-    for (int i = 0; i < size; ++i) {
-        timeBuffer[i] = i / sampleRate;
-        amplitudeBuffer[i] = timeData[i];
-    }
+    // Slots keep their storage, so these only allocate for the first frames
+    frame.amplitude.resize(size);
+    frame.magnitude.resize(fftSize);
+    frame.sampleRate = sampleRate;
     
-    int fftSize = size / 2;
-    freqBuffer.resize(fftSize);
-    magnitudeBuffer.resize(fftSize);
+    std::copy(timeData, timeData + size, frame.amplitude.begin());
     
+    // Normalize and convert to dB with floor at -80 dB in a single pass.
+    // Flooring the linear magnitude at 1e-4 is the same as clamping at -80 dB.
+    const double scale = 1.0 / fftLength;
+    const double floorMagnitude = 1e-4;
     for (int i = 0; i < fftSize; ++i) {
-        freqBuffer[i] = i * sampleRate / size;
-        // Convert to dB with floor at -80 dB
-        double mag = std::abs(fftData[i]) / size;
-        if (mag < 1e-10) mag = 1e-10;
-        magnitudeBuffer[i] = 20.0 * std::log10(mag);
-        if (magnitudeBuffer[i] < -80) magnitudeBuffer[i] = -80;
+        frame.magnitude[i] = 20.0 * std::log10(std::max(fftData[i] * scale, floorMagnitude));
     }
     
-    dataReady = true;
+    // Publish the slot to the GUI thread
+    ringHead.store(head + 1, std::memory_order_release);
 }
 
 void App::refreshPlots() {
-    QMutexLocker locker(&dataMutex);
-    
-    if (!dataReady) return;
-    
-    // Update time domain plot
-    timeDomainPlot->graph(0)->setData(timeBuffer, amplitudeBuffer);
-    timeDomainPlot->xAxis->setRange(0, timeBuffer.size() / currentSampleRate);
+    unsigned tail = ringTail.load(std::memory_order_relaxed);
+    unsigned head = ringHead.load(std::memory_order_acquire);
+    
+    if (tail == head) return;
+    
+    // Only the newest frame is shown, so older pending frames are skipped
+    // without being read
+    const AudioFrame& frame = frameRing[(head - 1) % FRAME_RING_SIZE];
+    int size = frame.amplitude.size();
+    int fftSize = frame.magnitude.size();
+    int fftLength = fftSize * 2; // Only the bins below Nyquist are stored
+    
+    // The axis values only depend on the frame sizes and sample rate, so
+    // they are only rebuilt when one of them changes
+    if (size != timeBuffer.size() || fftSize != freqBuffer.size() ||
+        frame.sampleRate != currentSampleRate) {
+        currentSampleRate = frame.sampleRate;
+        
+        timeBuffer.resize(size);
+        for (int i = 0; i < size; ++i) {
+            timeBuffer[i] = i / currentSampleRate;
+        }
+        
+        freqBuffer.resize(fftSize);
+        magnitudeBuffer.resize(fftSize);
+        for (int i = 0; i < fftSize; ++i) {
+            freqBuffer[i] = i * currentSampleRate / fftLength;
+        }
+        
+        // Group FFT bins into log-spaced bands for plotting. Low bands hold a
+        // single bin, high bands merge many bins into one point.
+        const double minFreq = 20.0;
+        const double maxFreq = currentSampleRate / 2;
+        logBandStarts.clear();
+        for (int k = 0; k < LOG_BAND_COUNT; ++k) {
+            double edge = minFreq * std::pow(maxFreq / minFreq, k / (double)(LOG_BAND_COUNT - 1));
+            int bin = (int)std::ceil(edge * fftLength / currentSampleRate);
+            if (bin >= fftSize) break;
+            if (logBandStarts.isEmpty() || bin > logBandStarts.last()) {
+                logBandStarts.append(bin);
+            }
+        }
+        
+        QVector<double> plotFreqs(logBandStarts.size());
+        for (int k = 0; k < logBandStarts.size(); ++k) {
+            plotFreqs[k] = freqBuffer[logBandStarts[k]];
+        }
+        
+        // Set the keys once; each frame only overwrites the values in place
+        timeDomainPlot->graph(0)->setData(timeBuffer, QVector<double>(size), true);
+        frequencyDomainPlot->graph(0)->setData(plotFreqs, QVector<double>(plotFreqs.size()), true);
+    }
     
-    // Auto-scale Y axis based on data
+    // Write samples straight from the ring slot into the time plot's data
+    // container, finding the peak for the auto-scaled Y axis on the way
     double maxAmp = 0.01;
-    for (const double& a : amplitudeBuffer) {
+    QCPGraphDataContainer::iterator point = timeDomainPlot->graph(0)->data()->begin();
+    for (double a : frame.amplitude) {
+        (point++)->value = a;
         if (std::abs(a) > maxAmp) maxAmp = std::abs(a);
     }
-    timeDomainPlot->yAxis->setRange(-maxAmp * 1.1, maxAmp * 1.1);
-    timeDomainPlot->replot();
     
-    // Update frequency domain plot
-    frequencyDomainPlot->graph(0)->setData(freqBuffer, magnitudeBuffer);
-    frequencyDomainPlot->replot();
+    // The full-resolution spectrum is kept for the dominant frequency label
+    std::copy(frame.magnitude.begin(), frame.magnitude.end(), magnitudeBuffer.begin());
+    
+    // Hand every pending slot back to the audio thread at once
+    ringTail.store(head, std::memory_order_release);
+    
+    // Each plotted band shows the loudest bin it covers
+    point = frequencyDomainPlot->graph(0)->data()->begin();
+    for (int k = 0; k < logBandStarts.size(); ++k) {
+        int end = k + 1 < logBandStarts.size() ? logBandStarts[k + 1] : fftSize;
+        (point++)->value = *std::max_element(magnitudeBuffer.begin() + logBandStarts[k],
+                                             magnitudeBuffer.begin() + end);
+    }
+    
+    // Update time domain plot
+    QCPRange timeRange(0, timeBuffer.size() / currentSampleRate);
+    QCPRange ampRange(-maxAmp * 1.1, maxAmp * 1.1);
+    
+    // Axes, ticks and grid only need repainting when a range changes;
+    // otherwise redrawing the data layer is enough
+    if (timeDomainPlot->xAxis->range() != timeRange || timeDomainPlot->yAxis->range() != ampRange) {
+        timeDomainPlot->xAxis->setRange(timeRange);
+        timeDomainPlot->yAxis->setRange(ampRange);
+        timeDomainPlot->replot();
+    } else {
+        timeDomainPlot->layer("data")->replot();
+    }
+    
+    // Update frequency domain plot. Its axes only change through user
+    // interaction, which triggers a full replot by itself.
+    frequencyDomainPlot->layer("data")->replot();
     
     // Update labels only every 250ms
     qint64 currentTime = QDateTime::currentMSecsSinceEpoch();
@@ -224,8 +305,6 @@ void App::refreshPlots() {
         
         lastLabelUpdateTime = currentTime;
     }
-    
-    dataReady = false;
 }
 
 void App::closeEvent(QCloseEvent *event) {
@@ -18,10 +18,22 @@
 
 #define SAMPLE_RATE 44100.0
 #define FRAMES_PER_BUFFER 512
-#define NUM_CHANNELS 2
+#define FFT_SIZE 1024 // Samples per FFT, independent of the callback block size
+#define FFT_HOP (FFT_SIZE / 2) // Samples between FFTs, giving consecutive windows 50% overlap
+#define NUM_CHANNELS 1 // Only the first channel is analysed, so capture mono
+#define FALLBACK_CHANNELS 2 // Channel count to retry with when a device refuses mono
+#define SAMPLE_SCALE (1.0f / 32768.0f) // Converts 16-bit samples to the [-1, 1) range
+#define LATENCY_BUFFERS 4 // Callback buffers the host-side capture buffer can hold
+#define INPUT_LATENCY (LATENCY_BUFFERS * FRAMES_PER_BUFFER / SAMPLE_RATE) // Suggested input latency (s)
+#define OPEN_BUSY_RETRIES 5 // 10 ms retries ALSA makes when a candidate device is busy
 
 #define SPECTRO_FREQ_START 20  // Lower bound of the displayed spectrogram (Hz)
 #define SPECTRO_FREQ_END 20000 // Upper bound of the displayed spectrogram (Hz)
+#define SPECTRO_LEVELS 8       // Number of block characters used to draw intensity
+#define SPECTRO_GLYPH_BYTES 3  // UTF-8 length of each block character
+#define CLEAR_LINE "\r\033[2K" // Returns to the start of the terminal line and clears it
+#define MAX_DISPLAY_COLUMNS 1024 // Widest spectrogram line that will be drawn
+#define SPECTRO_REDRAW_RATE 15 // CLI spectrogram redraws per second
 
 #define FILTER_ORDER 101  // Number of FIR filter taps
 
@@ -30,18 +42,34 @@ static App* g_app = nullptr;
 
 // Define callback data structure
 typedef struct {
-    double* in;
-    double* out;
-    double* filtered;     // Buffer for filtered audio
-    double* filterHistory; // History buffer for FIR filter (holds previous samples)
+    double* in;           // Windowed filtered audio, the FFT input
+    double* filtered;     // Filtered audio, time-domain data for the GUI
+    double* fftHistory;   // Circular buffer of the last FFT_SIZE filtered samples
+    int fftWrite;         // Index in fftHistory the next filtered sample goes to
+    unsigned long framesSinceFft; // Filtered samples added since the last FFT
+    double* window;       // Hann window applied before the FFT
+    fftw_complex* out;
+    double* magnitude;    // Magnitude of each FFT output bin
+    float* filterBuffer;  // FIR input: FILTER_ORDER - 1 previous samples followed by the current block
+    float filterTaps[FILTER_ORDER]; // Single-precision copy of the FIR coefficients in filt.h
     fftw_plan p;
     int inputChannels;
     int startIndex;  // First index of our FFT output to display in the spectrogram
     int spectroSize; // Number of elements in our FFT output to display from the start index
+    int dispSize;    // Number of terminal columns displayIndex was built for
+    int displayIndex[MAX_DISPLAY_COLUMNS]; // FFT output index shown in each terminal column
+    unsigned long framesSinceDraw; // Frames captured since the spectrogram was last drawn
+    int drawsSinceResize; // Redraws since the terminal width was last queried
+    char line[sizeof(CLEAR_LINE) - 1 + MAX_DISPLAY_COLUMNS * SPECTRO_GLYPH_BYTES]; // Spectrogram line being drawn
 } streamCallbackData;
 
 static streamCallbackData* spectroData;
 
+// Block characters used to draw the spectrogram, from quietest to loudest
+static const char* const spectroGlyphs[SPECTRO_LEVELS] = {
+    "▁", "▂", "▃", "▄", "▅", "▆", "▇", "█"
+};
+
 static void checkErr(PaError err) {
     if (err != paNoError) {
         printf("PortAudio error: %s\n", Pa_GetErrorText(err));
@@ -137,6 +165,16 @@ static int findInputDeviceByName(int numDevices, const char* pattern) {
     return paNoDevice;
 }
 
+// Whether a PortAudio device belongs to the ALSA host API.
+static bool isAlsaDevice(PaDeviceIndex device) {
+    const PaDeviceInfo* info = Pa_GetDeviceInfo(device);
+    if (info == NULL) {
+        return false;
+    }
+    const PaHostApiInfo* hostApi = Pa_GetHostApiInfo(info->hostApi);
+    return hostApi != NULL && hostApi->type == paALSA;
+}
+
 // Best-effort terminal width query for single-line CLI output.
 static int getTerminalColumns() {
     if (!isatty(STDOUT_FILENO)) {
@@ -150,6 +188,43 @@ static int getTerminalColumns() {
     return 100;
 }
 
+// Copies the first channel of an interleaved 16-bit input buffer, scaled to
+// [-1, 1). Mono and stereo streams get their own loops so the compiler sees a
+// constant stride.
+static void copyFirstChannel(const short* in, float* out, unsigned long frames, int channels) {
+    if (channels == 1) {
+        for (unsigned long i = 0; i < frames; i++) {
+            out[i] = in[i] * SAMPLE_SCALE;
+        }
+    } else if (channels == 2) {
+        for (unsigned long i = 0; i < frames; i++) {
+            out[i] = in[i * 2] * SAMPLE_SCALE;
+        }
+    } else {
+        for (unsigned long i = 0; i < frames; i++) {
+            out[i] = in[i * channels] * SAMPLE_SCALE;
+        }
+    }
+}
+
+// Fills `window` with a Hann window scaled by 2, so a windowed sinusoid keeps
+// the same peak FFT magnitude as an unwindowed one.
+static void buildHannWindow(double* window, int size) {
+    for (int i = 0; i < size; i++) {
+        window[i] = 1.0 - std::cos(2.0 * M_PI * i / (size - 1));
+    }
+}
+
+// Maps each terminal column to the FFT bin it displays, sampling frequency
+// data logarithmically. Only needs to run when the terminal width changes.
+static void buildDisplayIndex(streamCallbackData* data, int dispSize) {
+    for (int i = 0; i < dispSize; i++) {
+        double proportion = std::pow(i / (double)dispSize, 4);
+        data->displayIndex[i] = (int)(data->startIndex + proportion * data->spectroSize);
+    }
+    data->dispSize = dispSize;
+}
+
 static int streamCallback(
     const void* inputBuffer, void* outputBuffer, unsigned long framesPerBuffer,
     const PaStreamCallbackTimeInfo* timeInfo, PaStreamCallbackFlags statusFlags,
@@ -159,78 +234,111 @@ static int streamCallback(
     (void)timeInfo;
     (void)statusFlags;
 
-    float* in = (float*)inputBuffer;
+    short* in = (short*)inputBuffer;
     streamCallbackData* callbackData = (streamCallbackData*)userData;
 
-    // Copy audio sample to input buffer
+    // Copy audio sample after the previous FILTER_ORDER - 1 samples so every
+    // output sample is a plain dot product over contiguous memory. The 16-bit
+    // samples are only widened to float here, not to double.
+    float* history = callbackData->filterBuffer;
+    copyFirstChannel(in, history + FILTER_ORDER - 1, framesPerBuffer, callbackData->inputChannels);
+
+    // Apply FIR lowpass filter (2000Hz cutoff). Each output sample is kept for
+    // the GUI's time-domain plot and appended to the FFT history in the same pass.
+    const float* taps = callbackData->filterTaps;
+    double* fftHistory = callbackData->fftHistory;
+    int fftWrite = callbackData->fftWrite;
     for (unsigned long i = 0; i < framesPerBuffer; i++) {
-        callbackData->in[i] = in[i * callbackData->inputChannels];
-    }
-
-    // Apply FIR lowpass filter (2000Hz cutoff)
-    for (unsigned long i = 0; i < framesPerBuffer; i++) {
-        // Shift history buffer and add new sample
-        for (int j = FILTER_ORDER - 1; j > 0; j--) {
-            callbackData->filterHistory[j] = callbackData->filterHistory[j - 1];
-        }
-        callbackData->filterHistory[0] = callbackData->in[i];
-
-        // Convolve with filter coefficients
-        double filteredSample = 0.0;
+        // Newest sample for output i sits at history[i + FILTER_ORDER - 1]
+        const float* newest = history + i + FILTER_ORDER - 1;
+        float filteredSample = 0.0f;
+        // Lets the compiler reorder the sum so it can use SIMD lanes
+        #pragma omp simd reduction(+:filteredSample)
         for (int j = 0; j < FILTER_ORDER; j++) {
-            filteredSample += b[j] * callbackData->filterHistory[j];
+            filteredSample += taps[j] * newest[-j];
         }
         callbackData->filtered[i] = filteredSample;
+        fftHistory[fftWrite] = filteredSample;
+        if (++fftWrite == FFT_SIZE) {
+            fftWrite = 0;
+        }
     }
+    callbackData->fftWrite = fftWrite;
+
+    // Keep the tail of this block as history for the next callback
+    memmove(history, history + framesPerBuffer, sizeof(float) * (FILTER_ORDER - 1));
+
+    // Transform the most recent FFT_SIZE samples every FFT_HOP samples. Between
+    // hops the previous spectrum stays in magnitude.
+    callbackData->framesSinceFft += framesPerBuffer;
+    if (callbackData->framesSinceFft >= FFT_HOP) {
+        callbackData->framesSinceFft = 0;
+
+        // Unwrap the history oldest sample first while applying the window.
+        // The oldest sample sits at the write index.
+        const double* window = callbackData->window;
+        int olderCount = FFT_SIZE - fftWrite;
+        for (int i = 0; i < olderCount; i++) {
+            callbackData->in[i] = fftHistory[fftWrite + i] * window[i];
+        }
+        for (int i = 0; i < fftWrite; i++) {
+            callbackData->in[olderCount + i] = fftHistory[i] * window[olderCount + i];
+        }
 
-    // Perform FFT on filtered data
-    for (unsigned long i = 0; i < framesPerBuffer; i++) {
-        callbackData->in[i] = callbackData->filtered[i];
+        // Perform FFT on windowed data
+        fftw_execute(callbackData->p);
+
+        // Convert the complex FFT output to a magnitude per frequency bin
+        for (int i = 0; i <= FFT_SIZE / 2; i++) {
+            double re = callbackData->out[i][0];
+            double im = callbackData->out[i][1];
+            callbackData->magnitude[i] = std::sqrt(re * re + im * im);
+        }
     }
-    fftw_execute(callbackData->p);
 
     // Send filtered data to GUI if available
     if (g_app != nullptr) {
-        g_app->updateAudioData(callbackData->filtered, callbackData->out, 
-                               FRAMES_PER_BUFFER, SAMPLE_RATE);
+        g_app->updateAudioData(callbackData->filtered, FRAMES_PER_BUFFER,
+                               callbackData->magnitude, FFT_SIZE, SAMPLE_RATE);
+    }
+
+    // The callback runs SAMPLE_RATE / FRAMES_PER_BUFFER times a second, far
+    // more often than the terminal needs redrawing
+    callbackData->framesSinceDraw += framesPerBuffer;
+    if (callbackData->framesSinceDraw < SAMPLE_RATE / SPECTRO_REDRAW_RATE) {
+        return 0;
     }
+    callbackData->framesSinceDraw = 0;
 
-    // Draw CLI spectrogram
-    int dispSize = getTerminalColumns() - 1;
-    if (dispSize < 10) {
-        dispSize = 10;
+    // Draw CLI spectrogram. The terminal width is only queried about once a second.
+    if (callbackData->drawsSinceResize == 0) {
+        int columns = getTerminalColumns() - 1;
+        if (columns < 10) {
+            columns = 10;
+        }
+        if (columns > MAX_DISPLAY_COLUMNS) {
+            columns = MAX_DISPLAY_COLUMNS;
+        }
+        if (columns != callbackData->dispSize) {
+            buildDisplayIndex(callbackData, columns);
+        }
     }
-    printf("\r\033[2K");
+    callbackData->drawsSinceResize = (callbackData->drawsSinceResize + 1) % SPECTRO_REDRAW_RATE;
+    int dispSize = callbackData->dispSize;
 
+    // Build the whole line in memory so it reaches the terminal in one write
+    char* cursor = callbackData->line;
+    memcpy(cursor, CLEAR_LINE, sizeof(CLEAR_LINE) - 1);
+    cursor += sizeof(CLEAR_LINE) - 1;
     for (int i = 0; i < dispSize; i++) {
-        // Sample frequency data logarithmically
-        double proportion = std::pow(i / (double)dispSize, 4);
-        double freq = callbackData->out[(int)(callbackData->startIndex
-            + proportion * callbackData->spectroSize)];
+        double freq = callbackData->magnitude[callbackData->displayIndex[i]];
 
         // Display full block characters with heights based on frequency intensity
-        //max_freq = std::max(max_freq, freq);
-
-        if (freq < 0.125) {
-            printf("▁");
-        } else if (freq < 0.25) {
-            printf("▂");
-        } else if (freq < 0.375) {
-            printf("▃");
-        } else if (freq < 0.5) {
-            printf("▄");
-        } else if (freq < 0.625) {
-            printf("▅");
-        } else if (freq < 0.75) {
-            printf("▆");
-        } else if (freq < 0.875) {
-            printf("▇");
-        } else {
-            printf("█");
-        }
-
-        //std::cout << "Dominant frequency" << ": " << max_freq << "\n";
+        double level = std::min(std::max(freq * SPECTRO_LEVELS, 0.0), SPECTRO_LEVELS - 1.0);
+        memcpy(cursor, spectroGlyphs[(int)level], SPECTRO_GLYPH_BYTES);
+        cursor += SPECTRO_GLYPH_BYTES;
     }
+    fwrite(callbackData->line, 1, cursor - callbackData->line, stdout);
     fflush(stdout);
 
     return 0;
@@ -244,28 +352,43 @@ void audioThreadFunc() {
 
     // Allocate callback data
     spectroData = (streamCallbackData*)malloc(sizeof(streamCallbackData));
-    spectroData->in = (double*)malloc(sizeof(double) * FRAMES_PER_BUFFER);
-    spectroData->out = (double*)malloc(sizeof(double) * FRAMES_PER_BUFFER);
+    spectroData->in = fftw_alloc_real(FFT_SIZE);
+    spectroData->out = fftw_alloc_complex(FFT_SIZE / 2 + 1);
+    spectroData->magnitude = fftw_alloc_real(FFT_SIZE / 2 + 1);
     spectroData->filtered = (double*)malloc(sizeof(double) * FRAMES_PER_BUFFER);
-    spectroData->filterHistory = (double*)calloc(FILTER_ORDER, sizeof(double)); // Zero-initialized
-    if (spectroData->in == NULL || spectroData->out == NULL || 
-        spectroData->filtered == NULL || spectroData->filterHistory == NULL) {
+    spectroData->fftHistory = (double*)calloc(FFT_SIZE, sizeof(double)); // Zero-initialized
+    spectroData->window = (double*)malloc(sizeof(double) * FFT_SIZE);
+    spectroData->filterBuffer = (float*)calloc(FILTER_ORDER - 1 + FRAMES_PER_BUFFER, sizeof(float)); // Zero-initialized
+    if (spectroData->in == NULL || spectroData->out == NULL || spectroData->magnitude == NULL ||
+        spectroData->filtered == NULL || spectroData->fftHistory == NULL ||
+        spectroData->window == NULL || spectroData->filterBuffer == NULL) {
         printf("Could not allocate spectro data\n");
         exit(EXIT_FAILURE);
     }
-    spectroData->p = fftw_plan_r2r_1d(
-        FRAMES_PER_BUFFER, spectroData->in, spectroData->out,
-        FFTW_R2HC, FFTW_ESTIMATE
+    for (int j = 0; j < FILTER_ORDER; j++) {
+        spectroData->filterTaps[j] = (float)b[j];
+    }
+    buildHannWindow(spectroData->window, FFT_SIZE);
+    // Plan a real-to-complex transform once up front. FFTW_MEASURE takes a
+    // little longer to plan than FFTW_ESTIMATE but yields a faster transform
+    // for every callback afterwards.
+    spectroData->p = fftw_plan_dft_r2c_1d(
+        FFT_SIZE, spectroData->in, spectroData->out, FFTW_MEASURE
     );
     spectroData->inputChannels = NUM_CHANNELS;
     
     // Calculate spectrogram indices for CLI display
-    double sampleRatio = FRAMES_PER_BUFFER / SAMPLE_RATE;
+    double sampleRatio = FFT_SIZE / SAMPLE_RATE;
     spectroData->startIndex = std::ceil(sampleRatio * SPECTRO_FREQ_START);
     spectroData->spectroSize = min(
         std::ceil(sampleRatio * SPECTRO_FREQ_END),
-        FRAMES_PER_BUFFER / 2.0
+        FFT_SIZE / 2.0
     ) - spectroData->startIndex;
+    spectroData->dispSize = 0;
+    spectroData->fftWrite = 0;
+    spectroData->framesSinceFft = 0;
+    spectroData->framesSinceDraw = 0;
+    spectroData->drawsSinceResize = 0;
 
     int numDevices = Pa_GetDeviceCount();
     printf("Number of devices: %d\n", numDevices);
@@ -332,16 +455,17 @@ void audioThreadFunc() {
     // Define stream capture specifications
     PaStreamParameters inputParameters;
     memset(&inputParameters, 0, sizeof(inputParameters));
-    inputParameters.sampleFormat = paFloat32;
+    inputParameters.sampleFormat = paInt16;
     inputParameters.channelCount = NUM_CHANNELS;
 
-    PaAlsa_SetRetriesBusy(25);
+    PaAlsa_SetRetriesBusy(OPEN_BUSY_RETRIES);
 
     // Open the PortAudio stream
     PaStream* stream = NULL;
     PaError openErr = paNoError;
+    bool alsaStream = false;
     if (useAlsaDeviceString) {
-        const int channelCandidates[2] = {NUM_CHANNELS, 1};
+        const int channelCandidates[2] = {NUM_CHANNELS, FALLBACK_CHANNELS};
         char deviceCandidates[5][32];
         snprintf(deviceCandidates[0], sizeof(deviceCandidates[0]), "plughw:%d,0", thr5CardIndex);
         snprintf(deviceCandidates[1], sizeof(deviceCandidates[1]), "hw:%d,0", thr5CardIndex);
@@ -359,7 +483,7 @@ void audioThreadFunc() {
                 inputParameters.device = paUseHostApiSpecificDeviceSpecification;
                 inputParameters.hostApiSpecificStreamInfo = &alsaInfo;
                 inputParameters.channelCount = channelCandidates[c];
-                inputParameters.suggestedLatency = 0.010;
+                inputParameters.suggestedLatency = INPUT_LATENCY;
 
                 openErr = Pa_OpenStream(
                     &stream,
@@ -375,6 +499,11 @@ void audioThreadFunc() {
                     snprintf(alsaDeviceString, sizeof(alsaDeviceString), "%s", deviceCandidates[d]);
                     spectroData->inputChannels = channelCandidates[c];
                     opened = true;
+                    alsaStream = true;
+                } else if (openErr == paDeviceUnavailable) {
+                    // Still busy after the retries; another channel count
+                    // won't free it, so move on to the next device
+                    break;
                 }
             }
         }
@@ -387,11 +516,12 @@ void audioThreadFunc() {
             if (pulseDevice != paNoDevice) {
                 const PaDeviceInfo* pulseInfo = Pa_GetDeviceInfo(pulseDevice);
                 if (pulseInfo != NULL && pulseInfo->maxInputChannels > 0) {
-                    int pulseChannels = pulseInfo->maxInputChannels >= NUM_CHANNELS ? NUM_CHANNELS : 1;
+                    // PulseAudio mixes down to mono itself
+                    int pulseChannels = NUM_CHANNELS;
                     inputParameters.device = pulseDevice;
                     inputParameters.hostApiSpecificStreamInfo = NULL;
                     inputParameters.channelCount = pulseChannels;
-                    inputParameters.suggestedLatency = pulseInfo->defaultLowInputLatency;
+                    inputParameters.suggestedLatency = std::max(pulseInfo->defaultLowInputLatency, INPUT_LATENCY);
 
                     openErr = Pa_OpenStream(
                         &stream,
@@ -406,6 +536,7 @@ void audioThreadFunc() {
                     if (openErr == paNoError) {
                         spectroData->inputChannels = pulseChannels;
                         opened = true;
+                        alsaStream = isAlsaDevice(pulseDevice);
                     }
                 }
             }
@@ -426,7 +557,7 @@ void audioThreadFunc() {
         
         inputParameters.device = device;
         inputParameters.hostApiSpecificStreamInfo = NULL;
-        inputParameters.suggestedLatency = selectedDeviceInfo->defaultLowInputLatency;
+        inputParameters.suggestedLatency = std::max(selectedDeviceInfo->defaultLowInputLatency, INPUT_LATENCY);
 
         openErr = Pa_OpenStream(
             &stream,
@@ -443,6 +574,15 @@ void audioThreadFunc() {
             Pa_Terminate();
             return;
         }
+        alsaStream = isAlsaDevice(device);
+    }
+
+    // Run the callback thread with SCHED_FIFO so a busy desktop can't preempt
+    // it mid-buffer. This needs CAP_SYS_NICE or an rtprio limit (e.g. the
+    // audio group in /etc/security/limits.d); without it PortAudio quietly
+    // keeps normal scheduling. The call is only valid on ALSA streams.
+    if (alsaStream) {
+        PaAlsa_EnableRealtimeScheduling(stream, 1);
     }
 
     // Begin capturing audio
@@ -481,8 +621,11 @@ void audioThreadFunc() {
     fftw_destroy_plan(spectroData->p);
     fftw_free(spectroData->in);
     fftw_free(spectroData->out);
+    fftw_free(spectroData->magnitude);
     free(spectroData->filtered);
-    free(spectroData->filterHistory);
+    free(spectroData->fftHistory);
+    free(spectroData->window);
+    free(spectroData->filterBuffer);
     free(spectroData);
 
     printf("\n");
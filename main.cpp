@@ -16,18 +16,35 @@
 
 #define SAMPLE_RATE 44100.0   // How many audio samples to capture every second (44100 Hz is standard)
 #define FRAMES_PER_BUFFER 512 // How many audio samples to send to our callback function for each channel
-#define NUM_CHANNELS 2        // Number of audio channels to capture
+#define NUM_CHANNELS 1        // Only the first channel is analysed, so capture mono
+#define FALLBACK_CHANNELS 2   // Channel count to retry with when a device refuses mono
+#define SAMPLE_SCALE (1.0f / 32768.0f) // Converts 16-bit samples to the [-1, 1) range
+#define LATENCY_BUFFERS 4     // Callback buffers the host-side capture buffer can hold
+#define INPUT_LATENCY (LATENCY_BUFFERS * FRAMES_PER_BUFFER / SAMPLE_RATE) // Suggested input latency (s)
+#define OPEN_BUSY_RETRIES 5   // 10 ms retries ALSA makes when a candidate device is busy
 
 #define SPECTRO_FREQ_START 20  // Lower bound of the displayed spectrogram (Hz)
 #define SPECTRO_FREQ_END 20000 // Upper bound of the displayed spectrogram (Hz)
+#define SPECTRO_LEVELS 8       // Number of block characters used to draw intensity
+#define SPECTRO_GLYPH_BYTES 3  // UTF-8 length of each block character
+#define CLEAR_LINE "\r\033[2K" // Returns to the start of the terminal line and clears it
+#define MAX_DISPLAY_COLUMNS 1024 // Widest spectrogram line that will be drawn
+#define SPECTRO_REDRAW_RATE 15 // Spectrogram redraws per second
 
 // Define our callback data (data that is passed to every callback function call)
 typedef struct {
     double* in;      // Input buffer, will contain our audio sample
-    double* out;     // Output buffer, FFTW will write to this based on the input buffer's contents
+    fftw_complex* out; // Output buffer, FFTW will write to this based on the input buffer's contents
+    double* magnitude; // Magnitude of each FFT output bin
+    double* window;  // Hann window applied to the audio sample before the FFT
     fftw_plan p;     // Created by FFTW to facilitate FFT calculation
     int startIndex;  // First index of our FFT output to display in the spectrogram
     int spectroSize; // Number of elements in our FFT output to display from the start index
+    int dispSize;    // Number of terminal columns displayIndex was built for
+    int displayIndex[MAX_DISPLAY_COLUMNS]; // FFT output index shown in each terminal column
+    unsigned long framesSinceDraw; // Frames captured since the spectrogram was last drawn
+    int drawsSinceResize; // Redraws since the terminal width was last queried
+    char line[sizeof(CLEAR_LINE) - 1 + MAX_DISPLAY_COLUMNS * SPECTRO_GLYPH_BYTES]; // Spectrogram line being drawn
     int inputChannels; // Number of channels actually opened on the input stream
 } streamCallbackData;
 
@@ -35,6 +52,11 @@ typedef struct {
 // contains from within the callback function.
 static streamCallbackData* spectroData;
 
+// Block characters used to draw the spectrogram, from quietest to loudest
+static const char* const spectroGlyphs[SPECTRO_LEVELS] = {
+    "▁", "▂", "▃", "▄", "▅", "▆", "▇", "█"
+};
+
 // Checks the return value of a PortAudio function. Logs the message and exits
 // if there was an error
 static void checkErr(PaError err) {
@@ -134,6 +156,16 @@ static int findInputDeviceByName(int numDevices, const char* pattern) {
     return paNoDevice;
 }
 
+// Whether a PortAudio device belongs to the ALSA host API.
+static bool isAlsaDevice(PaDeviceIndex device) {
+    const PaDeviceInfo* info = Pa_GetDeviceInfo(device);
+    if (info == NULL) {
+        return false;
+    }
+    const PaHostApiInfo* hostApi = Pa_GetHostApiInfo(info->hostApi);
+    return hostApi != NULL && hostApi->type == paALSA;
+}
+
 // Best-effort terminal width query for single-line CLI output.
 static int getTerminalColumns() {
     if (!isatty(STDOUT_FILENO)) {
@@ -148,13 +180,50 @@ static int getTerminalColumns() {
 }
 
 
+// Copies the first channel of an interleaved 16-bit input buffer, scaled to
+// [-1, 1). Mono and stereo streams get their own loops so the compiler sees a
+// constant stride.
+static void copyFirstChannel(const short* in, double* out, unsigned long frames, int channels) {
+    if (channels == 1) {
+        for (unsigned long i = 0; i < frames; i++) {
+            out[i] = in[i] * SAMPLE_SCALE;
+        }
+    } else if (channels == 2) {
+        for (unsigned long i = 0; i < frames; i++) {
+            out[i] = in[i * 2] * SAMPLE_SCALE;
+        }
+    } else {
+        for (unsigned long i = 0; i < frames; i++) {
+            out[i] = in[i * channels] * SAMPLE_SCALE;
+        }
+    }
+}
+
+// Fills `window` with a Hann window scaled by 2, so a windowed sinusoid keeps
+// the same peak FFT magnitude as an unwindowed one.
+static void buildHannWindow(double* window, int size) {
+    for (int i = 0; i < size; i++) {
+        window[i] = 1.0 - std::cos(2.0 * M_PI * i / (size - 1));
+    }
+}
+
+// Maps each terminal column to the FFT bin it displays, sampling frequency
+// data logarithmically. Only needs to run when the terminal width changes.
+static void buildDisplayIndex(streamCallbackData* data, int dispSize) {
+    for (int i = 0; i < dispSize; i++) {
+        double proportion = std::pow(i / (double)dispSize, 4);
+        data->displayIndex[i] = (int)(data->startIndex + proportion * data->spectroSize);
+    }
+    data->dispSize = dispSize;
+}
+
 static int streamCallback(
     const void* inputBuffer, void* outputBuffer, unsigned long framesPerBuffer,
     const PaStreamCallbackTimeInfo* timeInfo, PaStreamCallbackFlags statusFlags,
     void* userData
 ) {
-    // Cast our input buffer to a float pointer (since our sample format is `paFloat32`)
-    float* in = (float*)inputBuffer;
+    // Cast our input buffer to a short pointer (since our sample format is `paInt16`)
+    short* in = (short*)inputBuffer;
 
     // We will not be modifying the output buffer. This line is a no-op.
     (void)outputBuffer;
@@ -162,49 +231,65 @@ static int streamCallback(
     // Cast our user data to streamCallbackData* so we can access its struct members
     streamCallbackData* callbackData = (streamCallbackData*)userData;
 
-    // Keep the spectrogram on one terminal line.
-    int dispSize = getTerminalColumns() - 1;
-    if (dispSize < 10) {
-        dispSize = 10;
+    // The callback runs SAMPLE_RATE / FRAMES_PER_BUFFER times a second, far
+    // more often than the terminal needs redrawing
+    callbackData->framesSinceDraw += framesPerBuffer;
+    if (callbackData->framesSinceDraw < SAMPLE_RATE / SPECTRO_REDRAW_RATE) {
+        return 0;
+    }
+    callbackData->framesSinceDraw = 0;
+
+    // Keep the spectrogram on one terminal line. The terminal width is only
+    // queried about once a second.
+    if (callbackData->drawsSinceResize == 0) {
+        int columns = getTerminalColumns() - 1;
+        if (columns < 10) {
+            columns = 10;
+        }
+        if (columns > MAX_DISPLAY_COLUMNS) {
+            columns = MAX_DISPLAY_COLUMNS;
+        }
+        if (columns != callbackData->dispSize) {
+            buildDisplayIndex(callbackData, columns);
+        }
     }
-    printf("\r\033[2K");
+    callbackData->drawsSinceResize = (callbackData->drawsSinceResize + 1) % SPECTRO_REDRAW_RATE;
+    int dispSize = callbackData->dispSize;
 
     // Copy audio sample to FFTW's input buffer
+    copyFirstChannel(in, callbackData->in, framesPerBuffer, callbackData->inputChannels);
+
+    // Window the sample to reduce spectral leakage between frequency bins
     for (unsigned long i = 0; i < framesPerBuffer; i++) {
-        callbackData->in[i] = in[i * callbackData->inputChannels];
+        callbackData->in[i] *= callbackData->window[i];
     }
 
     // Perform FFT on callbackData->in (results will be stored in callbackData->out)
     fftw_execute(callbackData->p);
 
-    // Draw the spectrogram
+    // Convert the complex FFT output to a magnitude per frequency bin
+    for (int i = 0; i <= FRAMES_PER_BUFFER / 2; i++) {
+        double re = callbackData->out[i][0];
+        double im = callbackData->out[i][1];
+        callbackData->magnitude[i] = std::sqrt(re * re + im * im);
+    }
+
+    // Draw the spectrogram. The whole line is built in memory so it reaches the
+    // terminal in a single write.
+    char* cursor = callbackData->line;
+    memcpy(cursor, CLEAR_LINE, sizeof(CLEAR_LINE) - 1);
+    cursor += sizeof(CLEAR_LINE) - 1;
     for (int i = 0; i < dispSize; i++) {
-        // Sample frequency data logarithmically
-        double proportion = std::pow(i / (double)dispSize, 4);
-        double freq = callbackData->out[(int)(callbackData->startIndex
-            + proportion * callbackData->spectroSize)];
+        double freq = callbackData->magnitude[callbackData->displayIndex[i]];
 
         // Display full block characters with heights based on frequency intensity
-        if (freq < 0.125) {
-            printf("▁");
-        } else if (freq < 0.25) {
-            printf("▂");
-        } else if (freq < 0.375) {
-            printf("▃");
-        } else if (freq < 0.5) {
-            printf("▄");
-        } else if (freq < 0.625) {
-            printf("▅");
-        } else if (freq < 0.75) {
-            printf("▆");
-        } else if (freq < 0.875) {
-            printf("▇");
-        } else {
-            printf("█");
-        }
+        double level = std::min(std::max(freq * SPECTRO_LEVELS, 0.0), SPECTRO_LEVELS - 1.0);
+        memcpy(cursor, spectroGlyphs[(int)level], SPECTRO_GLYPH_BYTES);
+        cursor += SPECTRO_GLYPH_BYTES;
     }
 
-    // Display the buffered changes to stdout in the terminal
+    // Display the line in the terminal
+    fwrite(callbackData->line, 1, cursor - callbackData->line, stdout);
     fflush(stdout);
 
     return 0;
@@ -218,15 +303,21 @@ int main() {
 
     // Allocate and define the callback data used to calculate/display the spectrogram
     spectroData = (streamCallbackData*)malloc(sizeof(streamCallbackData));
-    spectroData->in = (double*)malloc(sizeof(double) * FRAMES_PER_BUFFER);
-    spectroData->out = (double*)malloc(sizeof(double) * FRAMES_PER_BUFFER);
-    if (spectroData->in == NULL || spectroData->out == NULL) {
+    spectroData->in = fftw_alloc_real(FRAMES_PER_BUFFER);
+    spectroData->out = fftw_alloc_complex(FRAMES_PER_BUFFER / 2 + 1);
+    spectroData->magnitude = fftw_alloc_real(FRAMES_PER_BUFFER / 2 + 1);
+    spectroData->window = (double*)malloc(sizeof(double) * FRAMES_PER_BUFFER);
+    if (spectroData->in == NULL || spectroData->out == NULL || spectroData->magnitude == NULL ||
+        spectroData->window == NULL) {
         printf("Could not allocate spectro data\n");
         exit(EXIT_FAILURE);
     }
-    spectroData->p = fftw_plan_r2r_1d(
-        FRAMES_PER_BUFFER, spectroData->in, spectroData->out,
-        FFTW_R2HC, FFTW_ESTIMATE
+    buildHannWindow(spectroData->window, FRAMES_PER_BUFFER);
+    // Plan a real-to-complex transform once up front. FFTW_MEASURE takes a
+    // little longer to plan than FFTW_ESTIMATE but yields a faster transform
+    // for every callback afterwards.
+    spectroData->p = fftw_plan_dft_r2c_1d(
+        FRAMES_PER_BUFFER, spectroData->in, spectroData->out, FFTW_MEASURE
     );
     spectroData->inputChannels = NUM_CHANNELS;
     double sampleRatio = FRAMES_PER_BUFFER / SAMPLE_RATE;
@@ -235,6 +326,9 @@ int main() {
         std::ceil(sampleRatio * SPECTRO_FREQ_END),
         FRAMES_PER_BUFFER / 2.0
     ) - spectroData->startIndex;
+    spectroData->dispSize = 0;
+    spectroData->framesSinceDraw = 0;
+    spectroData->drawsSinceResize = 0;
 
     // Get and display the number of audio devices accessible to PortAudio
     int numDevices = Pa_GetDeviceCount();
@@ -303,16 +397,17 @@ int main() {
     // Define stream capture specifications
     PaStreamParameters inputParameters;
     memset(&inputParameters, 0, sizeof(inputParameters));
-    inputParameters.sampleFormat = paFloat32;
+    inputParameters.sampleFormat = paInt16;
     inputParameters.channelCount = NUM_CHANNELS;
 
-    PaAlsa_SetRetriesBusy(25);
+    PaAlsa_SetRetriesBusy(OPEN_BUSY_RETRIES);
 
     // Open the PortAudio stream
     PaStream* stream = NULL;
     PaError openErr = paNoError;
+    bool alsaStream = false;
     if (useAlsaDeviceString) {
-        const int channelCandidates[2] = {NUM_CHANNELS, 1};
+        const int channelCandidates[2] = {NUM_CHANNELS, FALLBACK_CHANNELS};
         char deviceCandidates[5][32];
         snprintf(deviceCandidates[0], sizeof(deviceCandidates[0]), "plughw:%d,0", thr5CardIndex);
         snprintf(deviceCandidates[1], sizeof(deviceCandidates[1]), "hw:%d,0", thr5CardIndex);
@@ -330,7 +425,7 @@ int main() {
                 inputParameters.device = paUseHostApiSpecificDeviceSpecification;
                 inputParameters.hostApiSpecificStreamInfo = &alsaInfo;
                 inputParameters.channelCount = channelCandidates[c];
-                inputParameters.suggestedLatency = 0.010; // 10 ms
+                inputParameters.suggestedLatency = INPUT_LATENCY;
 
                 openErr = Pa_OpenStream(
                     &stream,
@@ -346,6 +441,11 @@ int main() {
                     snprintf(alsaDeviceString, sizeof(alsaDeviceString), "%s", deviceCandidates[d]);
                     spectroData->inputChannels = channelCandidates[c];
                     opened = true;
+                    alsaStream = true;
+                } else if (openErr == paDeviceUnavailable) {
+                    // Still busy after the retries; another channel count
+                    // won't free it, so move on to the next device
+                    break;
                 }
             }
         }
@@ -359,11 +459,12 @@ int main() {
             if (pulseDevice != paNoDevice) {
                 const PaDeviceInfo* pulseInfo = Pa_GetDeviceInfo(pulseDevice);
                 if (pulseInfo != NULL && pulseInfo->maxInputChannels > 0) {
-                    int pulseChannels = pulseInfo->maxInputChannels >= NUM_CHANNELS ? NUM_CHANNELS : 1;
+                    // PulseAudio mixes down to mono itself
+                    int pulseChannels = NUM_CHANNELS;
                     inputParameters.device = pulseDevice;
                     inputParameters.hostApiSpecificStreamInfo = NULL;
                     inputParameters.channelCount = pulseChannels;
-                    inputParameters.suggestedLatency = pulseInfo->defaultLowInputLatency;
+                    inputParameters.suggestedLatency = std::max(pulseInfo->defaultLowInputLatency, INPUT_LATENCY);
 
                     openErr = Pa_OpenStream(
                         &stream,
@@ -378,6 +479,7 @@ int main() {
                     if (openErr == paNoError) {
                         spectroData->inputChannels = pulseChannels;
                         opened = true;
+                        alsaStream = isAlsaDevice(pulseDevice);
                     }
                 }
             }
@@ -391,7 +493,7 @@ int main() {
     } else {
         inputParameters.device = device;
         inputParameters.hostApiSpecificStreamInfo = NULL;
-        inputParameters.suggestedLatency = selectedDeviceInfo->defaultLowInputLatency;
+        inputParameters.suggestedLatency = std::max(selectedDeviceInfo->defaultLowInputLatency, INPUT_LATENCY);
         inputParameters.channelCount = NUM_CHANNELS;
 
         openErr = Pa_OpenStream(
@@ -405,6 +507,15 @@ int main() {
             spectroData
         );
         checkErr(openErr);
+        alsaStream = isAlsaDevice(device);
+    }
+
+    // Run the callback thread with SCHED_FIFO so a busy desktop can't preempt
+    // it mid-buffer. This needs CAP_SYS_NICE or an rtprio limit (e.g. the
+    // audio group in /etc/security/limits.d); without it PortAudio quietly
+    // keeps normal scheduling. The call is only valid on ALSA streams.
+    if (alsaStream) {
+        PaAlsa_EnableRealtimeScheduling(stream, 1);
     }
 
     // Begin capturing audio
@@ -430,6 +541,8 @@ int main() {
     fftw_destroy_plan(spectroData->p);
     fftw_free(spectroData->in);
     fftw_free(spectroData->out);
+    fftw_free(spectroData->magnitude);
+    free(spectroData->window);
     free(spectroData);
 
     printf("\n");